@@ -1,171 +1,139 @@
 # app/controllers/vision_controller.py
-import base64
+import asyncio
 import logging
-from typing import Dict, Any
+from typing import Any, Callable, Dict, Optional
 import openai
 import os
-from PIL import Image
-import io
+from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
 
+# Static instructions for the vision model. Keeping them identical across
+# requests, ahead of the per-request challenge and image, lets the provider
+# reuse the prompt prefix.
+VISION_SYSTEM = """You are helping judge a drawing game for kids. Look at each drawing carefully.
+
+Please analyze:
+1. What do you see in this drawing?
+2. Does it reasonably match what they were asked to draw?
+3. Remember this is a child's drawing - be encouraging but honest.
+
+Respond with:
+match: true or false
+description: what you see
+message: encouraging message for the child
+
+Be generous with simple drawings but honest about completely unrelated drawings."""
+
+class VisionVerdict(BaseModel):
+    """Structured output schema for the vision model"""
+    match: bool
+    description: str
+    message: str
+
 class OpenAIVisionController:
-    """Simple OpenAI Vision API controller with DALL-E integration"""
+    """OpenAI Vision API controller with DALL-E integration
     
-    def __init__(self):
-        # Load environment variables first
-        from dotenv import load_dotenv
-        load_dotenv()
-        
-        # Get API key from environment
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY environment variable is not set")
+    Errors from the API are raised to the caller, which decides on the
+    fallback response.
+    """
+    
+    def __init__(self, client: openai.AsyncOpenAI, max_concurrency: int = 16):
+        # Reuse the application's client so calls share one connection pool
+        self.client = client
         
-        # Set API key and create client
-        openai.api_key = api_key
-        self.client = openai.OpenAI(api_key=api_key)
+        # Cap in-flight OpenAI calls so concurrent requests stay within rate limits
+        self.semaphore = asyncio.Semaphore(max_concurrency)
         
-    def analyze_image(self, base64_image: str, challenge_object: str) -> Dict[str, Any]:
+    async def analyze_image(self, base64_image: str, challenge_object: str,
+                            on_match: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
         """
         Analyze drawing using OpenAI Vision API
         
+        The verdict is streamed; once it says the drawing matches and the
+        description is complete, on_match(description) is called so the
+        caller can start work early.
+        
         Args:
-            base64_image: Base64 encoded image from canvas
+            base64_image: Base64 encoded PNG of the prepared drawing
             challenge_object: What the user was supposed to draw
-            
+            on_match: Optional callback for an early match signal
+        
         Returns:
-            Dict with analysis results
+            Dict with is_match, description and message
         """
-        try:
-            # Clean up base64 image data
-            if ',' in base64_image:
-                base64_image = base64_image.split(',')[1]
-                
-            # Create the prompt
-            prompt = f"""
-            Look at this drawing. The user was asked to draw a {challenge_object}.
-            
-            Please respond with:
-            1. What you see in the drawing
-            2. Whether it matches the challenge (YES/NO)
-            3. A fun, encouraging message for the user
-            
-            Keep it simple and positive for a drawing game.
-            """
-            
-            # Make API call
-            response = self.client.chat.completions.create(
-                model="gpt-4-vision-preview",
+        # Make API call to OpenAI
+        async with self.semaphore:
+            async with self.client.beta.chat.completions.stream(
+                model="gpt-4o",
                 messages=[
+                    {
+                        "role": "system",
+                        "content": VISION_SYSTEM
+                    },
                     {
                         "role": "user",
                         "content": [
                             {
                                 "type": "text",
-                                "text": prompt
+                                "text": f'The child was asked to draw: "{challenge_object}"'
                             },
                             {
                                 "type": "image_url",
                                 "image_url": {
-                                    "url": f"data:image/png;base64,{base64_image}"
+                                    "url": f"data:image/png;base64,{base64_image}",
+                                    "detail": "low"
                                 }
                             }
                         ]
                     }
                 ],
-                max_tokens=300
-            )
-            
-            # Parse response
-            ai_response = response.choices[0].message.content
-            
-            # Simple parsing to extract if it's a match
-            is_match = "YES" in ai_response.upper()
+                response_format=VisionVerdict,
+                max_tokens=300,
+                temperature=0.3  # Lower temperature for more consistent responses
+            ) as stream:
+                # The schema puts match first, so watch the partial JSON as it arrives;
+                # strings only show up in it once they are complete
+                notified = on_match is None
+                async for event in stream:
+                    if notified or event.type != "content.delta" or not event.parsed:
+                        continue
+                    partial = event.parsed
+                    if partial.get("match") is False:
+                        notified = True
+                    elif partial.get("match") is True and "description" in partial:
+                        notified = True
+                        on_match(partial["description"])
             
-            return {
-                "success": True,
-                "ai_response": ai_response,
-                "is_match": is_match,
-                "challenge_object": challenge_object,
-                "error": None
-            }
-            
-        except Exception as e:
-            logger.error(f"OpenAI Vision API failed: {e}")
-            return {
-                "success": False,
-                "ai_response": None,
-                "is_match": False,
-                "challenge_object": challenge_object,
-                "error": str(e)
-            }
+                response = await stream.get_final_completion()
+        
+        # The SDK validates the response against VisionVerdict for us
+        result = response.choices[0].message
+        if result.parsed is None:
+            raise ValueError(f"Vision model refused: {result.refusal}")
+        
+        verdict = result.parsed
+        logger.info(f"OpenAI response: {verdict}")
+        
+        return {
+            "is_match": verdict.match,
+            "description": verdict.description,
+            "message": verdict.message
+        }
     
-    def generate_reward_image(self, user_drawing_description: str, challenge_object: str) -> Dict[str, Any]:
-        """Generate reward image based on description of user's drawing"""
-        try:
-            # Create detailed prompt based on what the AI saw in the drawing
-            prompt = f"A beautiful, professional digital artwork inspired by a child's drawing. The child drew a {challenge_object} and it looks like: {user_drawing_description}. Transform this into a magical, colorful masterpiece while keeping the child's creative vision. Fantasy art style, vibrant colors, whimsical and joyful."
-            
-            response = self.client.images.generate(
+    async def generate_reward_image(self, user_drawing_description: str, challenge_object: str) -> str:
+        """Generate reward image based on description of user's drawing and return its URL"""
+        dalle_prompt = f"A beautiful, professional digital artwork inspired by a child's drawing. The child drew a {challenge_object} and it looks like: {user_drawing_description}. Transform this into a magical, colorful masterpiece while keeping the child's creative vision. Fantasy art style, vibrant colors, whimsical and joyful."
+        
+        async with self.semaphore:
+            dalle_response = await self.client.images.generate(
                 model="dall-e-3",
-                prompt=prompt,
+                prompt=dalle_prompt,
                 size="1024x1024",
                 n=1
             )
-            
-            return {
-                "success": True,
-                "image_url": response.data[0].url
-            }
-            
-        except Exception as e:
-            logger.error(f"DALL-E failed: {e}")
-            return {
-                "success": False,
-                "image_url": None
-            }
-    
-    def generate_game_response(self, analysis_result: Dict[str, Any]) -> Dict[str, Any]:
-        """Convert AI analysis into game response with optional image generation"""
-        
-        if not analysis_result["success"]:
-            return {
-                "title": "Oops!",
-                "message": "I couldn't analyze your drawing right now. Try again!",
-                "points": 0,
-                "success": False
-            }
         
-        ai_response = analysis_result["ai_response"]
-        is_match = analysis_result["is_match"]
-        
-        if is_match:
-            # Generate reward image based on what AI saw in the drawing
-            reward = self.generate_reward_image(ai_response, analysis_result["challenge_object"])
-            
-            response = {
-                "title": "Amazing!",
-                "message": ai_response,
-                "points": 100,
-                "success": True
-            }
-            
-            # Add image if generation worked
-            if reward["success"]:
-                response["reward_image"] = reward["image_url"]
-                response["message"] += " Check out your masterpiece!"
-            else:
-                logger.warning("Image generation failed, continuing without image")
-                
-            return response
-        else:
-            return {
-                "title": "Try Again!",
-                "message": ai_response,
-                "points": 25,
-                "success": False
-            }
+        return dalle_response.data[0].url
     
     def health_check(self) -> Dict[str, Any]:
         """Check if OpenAI API is configured properly"""
@@ -176,6 +144,3 @@ class OpenAIVisionController:
             "service": "OpenAI Vision API + DALL-E",
             "model": "gpt-4o + dall-e-3"
         }
-
-# Singleton instance
-openai_vision_controller = OpenAIVisionController()
\ No newline at end of file
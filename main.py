@@ -1,16 +1,26 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse
+from pydantic import BaseModel, ConfigDict, StringConstraints
+from typing import Annotated, List, Optional
+import asyncio
 import base64
-from PIL import Image
+import binascii
+import functools
+from contextlib import asynccontextmanager
+import hashlib
+import numpy as np
 import io
 import os
+import re
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
+from cachetools import LRUCache, TTLCache
 import openai
+from controllers.vision_controller import OpenAIVisionController
 
 # Load environment variables first
 load_dotenv()
@@ -19,7 +29,34 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Scribble Quest Backend")
+# Upload budget: the canvas data URL plus room for the other JSON fields
+MAX_IMAGE_CHARS = 8_000_000
+MAX_BODY_BYTES = MAX_IMAGE_CHARS + 64_000
+
+@asynccontextmanager
+async def lifespan(app):
+    """Start the background workers and release shared resources on shutdown"""
+    # Batch vision requests and pre-generate drawing challenges
+    vision_dispatcher.start()
+    question_refill_task = asyncio.create_task(_refill_questions_loop())
+    
+    yield
+    
+    question_refill_task.cancel()
+    await vision_dispatcher.stop()
+    _image_executor.shutdown(wait=False)
+    await _http.aclose()
+
+app = FastAPI(title="Scribble Quest Backend", lifespan=lifespan)
+
+# Registered before CORS so 413 responses still get CORS headers
+@app.middleware("http")
+async def limit_body_size(request, call_next):
+    """Reject oversized uploads before the body is read and validated"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_BODY_BYTES:
+        return JSONResponse({"detail": "Request body too large"}, status_code=413)
+    return await call_next(request)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,56 +69,245 @@ app.add_middleware(
 # Mount static files directory
 app.mount("/static", StaticFiles(directory="Scribble_quest"), name="static")
 
-# Initialize LangChain OpenAI for question generation
-llm = ChatOpenAI(
-    model="gpt-3.5-turbo",
-    openai_api_key=os.getenv("OPENAI_API_KEY")
+# Shared connection pool so OpenAI calls reuse warm TCP/TLS connections
+_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    timeout=httpx.Timeout(60.0, connect=5.0)
 )
 
 # Initialize OpenAI client for vision
-openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+openai_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=_http)
+
+# All vision and DALL-E calls go through the controller
+openai_vision_controller = OpenAIVisionController(openai_client)
+
+# Image decoding/analysis runs here, one thread per core, so CPU work for
+# new requests overlaps with other requests waiting on OpenAI
+_image_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="image")
+
+# Ready-made drawing challenges, refilled in the background
+_question_pool = asyncio.Queue(maxsize=50)
+QUESTIONS_PER_REQUEST = 5
+QUESTION_RETRY_DELAY = 30
+
+# One "Draw a/an <object>" challenge per line, optionally numbered, bulleted,
+# quoted or bold, with any trailing punctuation
+_DRAW_RE = re.compile(r"(?mi)^\s*(?:\d+[.)\-])?\s*(?:[-*•\"]\s*)*(Draw an? [^\n!?.*\"]{2,60})[!.?]*\**\"?\s*$")
+
+FALLBACK_QUESTIONS = [
+    "Draw a cat!",
+    "Draw a house!",
+    "Draw a car!",
+    "Draw a tree!",
+    "Draw a flower!"
+]
+
+# The drawing check first looks at every SAMPLE_STEP-th pixel in each direction
+# and only scans the full canvas when that sample isn't conclusive
+SAMPLE_STEP = 8
+
+# Vision verdicts keyed by (upload hash, challenge object)
+_vision_cache = LRUCache(maxsize=2048)
+
+# DALL-E URLs keyed by (description, challenge object); OpenAI expires them after an hour
+_reward_cache = TTLCache(maxsize=512, ttl=50 * 60)
 
 class DrawingRequest(BaseModel):
-    image: str
-    challenge: str
+    model_config = ConfigDict(extra='ignore')
+    
+    image: Annotated[str, StringConstraints(max_length=MAX_IMAGE_CHARS)]
+    challenge: Annotated[str, StringConstraints(max_length=200)]
     level: int
     session_id: str = "default"
 
-def process_image(image_data_url):
-    """Convert base64 image to PIL Image and analyze it"""
+# Response models let FastAPI serialize straight to JSON bytes via Pydantic
+class QuestionsResponse(BaseModel):
+    questions: List[str]
+
+class DrawingResult(BaseModel):
+    title: str
+    message: str
+    points: int
+    success: bool
+    reward_image: Optional[str] = None
+
+class HealthResponse(BaseModel):
+    status: str
+    message: str
+    api_key_configured: bool
+    openai_model: str
+
+@functools.lru_cache(maxsize=1)
+def _get_llm():
+    """Initialize LangChain OpenAI for question generation on first use"""
+    from langchain_openai import ChatOpenAI
+    
+    return ChatOpenAI(
+        model="gpt-3.5-turbo",
+        openai_api_key=os.getenv("OPENAI_API_KEY")
+    )
+
+def process_image(image, mask):
+    """Analyze a decoded drawing from its non-white pixel mask (or a strided sample of it)"""
+    drawing_pixels = int(mask.sum())
+    
+    return {
+        "size": image.size,
+        "drawing_density": drawing_pixels / mask.size,
+        "has_drawing": drawing_pixels > 100
+    }
+
+def preprocess_for_vision(image, mask):
+    """Crop to the drawn strokes and downscale to keep vision tokens low"""
+    from PIL import Image
+    
+    # Crop to the bounding box of non-white pixels
+    coords = np.argwhere(mask)
+    if coords.size:
+        (top, left), (bottom, right) = coords.min(0), coords.max(0)
+        image = image.crop((left, top, right + 1, bottom + 1))
+    
+    image.thumbnail((512, 512), Image.LANCZOS)
+    
+    # Strokes are a single dark colour, so grayscale loses nothing and keeps
+    # the inline payload small
+    buffer = io.BytesIO()
+    image.convert("L").save(buffer, format="PNG", optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+def image_digest(image_data_url):
+    """Hash the uploaded data URL for use as a cache key"""
+    return hashlib.blake2b(image_data_url.encode(), digest_size=16).digest()
+
+def prepare_image(image_data_url):
+    """Decode the canvas data URL once and return (analysis, base64 image for vision)"""
+    from PIL import Image
+    
     try:
-        # Remove the data URL prefix
-        image_data = image_data_url.split(',')[1]
+        # Slice off the data URL prefix without copying and decode
+        raw = image_data_url.encode("ascii")
+        comma = raw.find(b",")
+        payload = raw if comma < 0 else memoryview(raw)[comma + 1:]
+        image = Image.open(io.BytesIO(binascii.a2b_base64(payload)))
         
-        # Decode base64 to bytes
-        image_bytes = base64.b64decode(image_data)
+        # The canvas is transparent, so flatten it onto white first
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+            image = Image.alpha_composite(background, image)
+        image = image.convert("RGB")
         
-        # Open as PIL Image
-        image = Image.open(io.BytesIO(image_bytes))
+        # Count non-white pixels (drawing strokes) on one contiguous array
+        # rather than a per-pixel Python list
+        pixels = np.asarray(image)
         
-        # Basic analysis - count non-white pixels (drawing strokes)
-        pixels = list(image.getdata())
-        drawing_pixels = sum(1 for pixel in pixels if sum(pixel[:3]) < 750)  # Not white
+        # The sample is a subset of the canvas, so if it already has more than
+        # 100 dark pixels the full image does too
+        sample = pixels[::SAMPLE_STEP, ::SAMPLE_STEP].sum(axis=2, dtype=np.uint16) < 750
+        analysis = process_image(image, sample)
         
-        return {
-            "size": image.size,
-            "drawing_density": drawing_pixels / len(pixels),
-            "has_drawing": drawing_pixels > 100
-        }
+        mask = pixels.sum(axis=2, dtype=np.uint16) < 750
+        if not analysis["has_drawing"]:
+            # Thin strokes can fall between sampled rows; decide on the full mask
+            analysis = process_image(image, mask)
+            if not analysis["has_drawing"]:
+                return analysis, None
+        
+        return analysis, preprocess_for_vision(image, mask)
     except Exception as e:
         logger.error(f"Image processing error: {e}")
-        return {"error": str(e)}
+        return {"error": str(e)}, None
+
+async def generate_reward_image(description, challenge_object):
+    """Return a DALL-E reward image URL, reusing recent ones for the same description"""
+    reward_key = (description, challenge_object)
+    image_url = _reward_cache.get(reward_key)
+    if image_url is not None:
+        return image_url
+    
+    logger.info(f"Generating DALL-E image for: {description}")
+    image_url = await openai_vision_controller.generate_reward_image(description, challenge_object)
+    _reward_cache[reward_key] = image_url
+    return image_url
+
+class VisionDispatcher:
+    """Collects concurrent vision requests into micro-batches and issues each batch at once"""
+    
+    def __init__(self, handler, max_batch=8, max_wait=0.05):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = None
+        self.worker = None
+        self.batches = set()
+    
+    def start(self):
+        """Start the background worker on the running event loop"""
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Cancel the worker and any batches still in flight"""
+        for task in [self.worker, *self.batches]:
+            if task:
+                task.cancel()
+    
+    async def submit(self, *args):
+        """Queue a request and wait for its result"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((args, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            
+            # Take whatever is already queued without waiting
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            
+            # A lone request goes out immediately; only when others were already
+            # queued (i.e. we're busy) wait up to max_wait to fill the batch
+            deadline = loop.time() + self.max_wait
+            while 1 < len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Run the batch in its own task so collecting the next one isn't blocked
+            task = asyncio.create_task(self._dispatch(batch))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+    
+    async def _dispatch(self, batch):
+        results = await asyncio.gather(
+            *(self.handler(*args) for args, _ in batch),
+            return_exceptions=True
+        )
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+vision_dispatcher = VisionDispatcher(openai_vision_controller.analyze_image)
 
 @app.get("/")
 async def serve_game():
     """Serve the main game HTML file"""
     return FileResponse("Scribble_quest/index.html")
 
-@app.get("/api/generate-questions")
-async def generate_questions():
-    """Generate object-based drawing challenges using LangChain"""
-    try:
-        response = llm.invoke("""Generate 5 simple object drawing challenges for kids. Focus only on concrete objects that can be drawn and recognized:
+async def _generate_questions():
+    """Generate a batch of object-based drawing challenges using LangChain"""
+    response = await _get_llm().ainvoke("""Generate 10 simple object drawing challenges for kids. Focus only on concrete objects that can be drawn and recognized:
 
 Examples:
 - Draw a cat
@@ -100,62 +326,44 @@ Requirements:
 - Keep them very simple
 - End with exclamation mark
 
-Generate 5 object-based challenges:""")
-        
-        # Split response into individual questions
-        questions = []
-        for line in response.content.split('\n'):
-            line = line.strip()
-            # Remove numbering and bullets
-            line = line.lstrip('123456789.- ')
-            
-            if line.lower().startswith('draw') and len(line) > 8:
-                if not line.endswith('!'):
-                    line += '!'
-                questions.append(line)
-        
-        return {"questions": questions}
-        
-    except Exception as e:
-        logger.error(f"Error generating questions: {e}")
-        # Fallback questions if LangChain fails
-        return {
-            "questions": [
-                "Draw a cat!",
-                "Draw a house!",
-                "Draw a car!",
-                "Draw a tree!",
-                "Draw a flower!"
-            ]
-        }
-
-@app.post("/api/analyze-drawing")
-async def analyze_drawing(request: DrawingRequest):
-    logger.info(f"Received drawing for challenge: {request.challenge}")
-    
-    # First do basic image check
-    image_analysis = process_image(request.image)
-    
-    if "error" in image_analysis:
-        return {
-            "title": "Error!",
-            "message": "Could not process your drawing. Try again!",
-            "points": 0,
-            "success": False
-        }
+Generate 10 object-based challenges:""")
     
-    logger.info(f"Image analysis: {image_analysis}")
+    # Pull "Draw a/an ..." lines out of the response, skipping numbering and bullets
+    questions = [f"{m.group(1).strip()}!" for m in _DRAW_RE.finditer(response.content)]
     
-    # Check if there's actually a drawing
-    has_drawing = image_analysis.get("has_drawing", False)
+    return questions
+
+async def _refill_questions_loop():
+    """Keep the question pool topped up in the background"""
+    while True:
+        try:
+            questions = await _generate_questions()
+            # put() waits while the pool is full, so this only calls the LLM when needed
+            for question in questions:
+                await _question_pool.put(question)
+            if not questions:
+                await asyncio.sleep(QUESTION_RETRY_DELAY)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error generating questions: {e}")
+            await asyncio.sleep(QUESTION_RETRY_DELAY)
+
+@app.get("/api/generate-questions", response_model=QuestionsResponse)
+async def generate_questions():
+    """Serve drawing challenges from the pre-generated pool"""
+    if _question_pool.qsize() < QUESTIONS_PER_REQUEST:
+        logger.warning("Question pool is running low, using fallback questions")
+        # Fallback questions if the pool hasn't caught up yet
+        return {"questions": list(FALLBACK_QUESTIONS)}
     
-    if not has_drawing:
-        return {
-            "title": "No Drawing!",
-            "message": "I don't see any drawing. Try drawing something!",
-            "points": 0,
-            "success": False
-        }
+    return {
+        "questions": [_question_pool.get_nowait() for _ in range(QUESTIONS_PER_REQUEST)]
+    }
+
+@app.post("/api/analyze-drawing", response_model=DrawingResult, response_model_exclude_none=True)
+async def analyze_drawing(request: DrawingRequest):
+    logger.info(f"Received drawing for challenge: {request.challenge}")
     
     # Extract the object from the challenge text
     challenge_text = request.challenge.lower().strip()
@@ -179,78 +387,57 @@ async def analyze_drawing(request: DrawingRequest):
     if not challenge_object or len(challenge_object) < 2:
         challenge_object = request.challenge
     
-    # Call OpenAI Vision API
-    try:
-        # Clean up base64 image data
-        base64_image = request.image
-        if ',' in base64_image:
-            base64_image = base64_image.split(',')[1]
-        
-        logger.info(f"Sending image to OpenAI Vision API for object: {challenge_object}")
-        
-        # Create a specific prompt for drawing validation
-        prompt = f"""
-        You are helping judge a drawing game for kids. Look at this drawing carefully.
-        
-        The child was asked to draw: "{challenge_object}"
-        
-        Please analyze:
-        1. What do you see in this drawing?
-        2. Does it reasonably match what they were asked to draw?
-        3. Remember this is a child's drawing - be encouraging but honest.
-        
-        Respond in this exact format:
-        MATCH: YES or NO
-        DESCRIPTION: [what you see]
-        MESSAGE: [encouraging message for the child]
+    # Identical drawings for the same challenge reuse the earlier verdict, so a
+    # cache hit never needs the image decoded or its pixels loaded
+    loop = asyncio.get_running_loop()
+    image_hash = await loop.run_in_executor(_image_executor, image_digest, request.image)
+    cache_key = (image_hash, challenge_object)
+    verdict = _vision_cache.get(cache_key)
+    
+    if verdict is None:
+        # Decode and analyze the image once (off the event loop, it's CPU bound)
+        image_analysis, base64_image = await loop.run_in_executor(_image_executor, prepare_image, request.image)
         
-        Be generous with simple drawings but honest about completely unrelated drawings.
-        """
+        if "error" in image_analysis:
+            return {
+                "title": "Error!",
+                "message": "Could not process your drawing. Try again!",
+                "points": 0,
+                "success": False
+            }
         
-        # Make API call to OpenAI
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=300,
-            temperature=0.3  # Lower temperature for more consistent responses
-        )
+        logger.info(f"Image analysis: {image_analysis}")
         
-        # Parse the AI response
-        ai_response = response.choices[0].message.content.strip()
-        logger.info(f"OpenAI response: {ai_response}")
+        # Check if there's actually a drawing
+        has_drawing = image_analysis.get("has_drawing", False)
         
-        # Extract match result
-        is_match = False
-        description = "I can see your drawing!"
-        message = "Great effort on your drawing!"
+        if not has_drawing:
+            return {
+                "title": "No Drawing!",
+                "message": "I don't see any drawing. Try drawing something!",
+                "points": 0,
+                "success": False
+            }
+    
+    # DALL-E is started from the vision stream as soon as a match is known
+    reward_task = None
+    
+    def start_reward(description):
+        nonlocal reward_task
+        reward_task = asyncio.create_task(generate_reward_image(description, challenge_object))
+    
+    # Call OpenAI Vision API
+    try:
+        if verdict is None:
+            logger.info(f"Sending image to OpenAI Vision API for object: {challenge_object}")
+            verdict = await vision_dispatcher.submit(base64_image, challenge_object, start_reward)
+            _vision_cache[cache_key] = verdict
+        else:
+            logger.info(f"Using cached vision verdict for object: {challenge_object}")
         
-        # Parse the structured response
-        lines = ai_response.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith('MATCH:'):
-                match_text = line.replace('MATCH:', '').strip().upper()
-                is_match = 'YES' in match_text
-            elif line.startswith('DESCRIPTION:'):
-                description = line.replace('DESCRIPTION:', '').strip()
-            elif line.startswith('MESSAGE:'):
-                message = line.replace('MESSAGE:', '').strip()
+        is_match = verdict["is_match"]
+        description = verdict["description"]
+        message = verdict["message"]
         
         # Generate game response based on match result
         if is_match:
@@ -263,17 +450,11 @@ async def analyze_drawing(request: DrawingRequest):
             
             # Generate DALL-E image for successful drawings
             try:
-                logger.info(f"Generating DALL-E image for: {description}")
-                dalle_prompt = f"A beautiful, professional digital artwork inspired by a child's drawing. The child drew a {challenge_object} and it looks like: {description}. Transform this into a magical, colorful masterpiece while keeping the child's creative vision. Fantasy art style, vibrant colors, whimsical and joyful."
+                if reward_task is not None:
+                    image_url = await reward_task
+                else:
+                    image_url = await generate_reward_image(description, challenge_object)
                 
-                dalle_response = openai_client.images.generate(
-                    model="dall-e-3",
-                    prompt=dalle_prompt,
-                    size="1024x1024",
-                    n=1
-                )
-                
-                image_url = dalle_response.data[0].url
                 response_data["reward_image"] = image_url
                 response_data["message"] += " Check out your masterpiece!"
                 logger.info(f"DALL-E image generated successfully: {image_url}")
@@ -293,6 +474,8 @@ async def analyze_drawing(request: DrawingRequest):
             
     except Exception as e:
         logger.error(f"OpenAI Vision API failed: {e}")
+        if reward_task is not None:
+            reward_task.cancel()
         
         # Fallback response when API fails
         return {
@@ -303,10 +486,10 @@ async def analyze_drawing(request: DrawingRequest):
         }
         
 
-@app.get("/api/health")
+@app.get("/api/health", response_model=HealthResponse)
 async def health_check():
     """Check backend health including API configuration"""
-    api_key_configured = bool(os.getenv("OPENAI_API_KEY"))
+    api_key_configured = openai_vision_controller.health_check()["api_key_configured"]
     
     return {
         "status": "healthy", 
@@ -315,6 +498,18 @@ async def health_check():
         "openai_model": "gpt-4o"
     }
 
-# if __name__ == "__main__":
-#     import uvicorn
-#     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+if __name__ == "__main__":
+    import uvicorn
+    
+    # "auto" picks uvloop and httptools when uvicorn[standard] is installed,
+    # and falls back to asyncio/h11 on platforms without them (e.g. Windows).
+    # Each worker is its own process with its own caches and question pool.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=os.cpu_count() or 1,
+        proxy_headers=True
+    )